@@ -10,14 +10,21 @@ Copyright (c) 2024 Ishan Chakraborty
 """
 import streamlit as st
 from pathlib import Path
+import os
 import time
-import base64
+import html
+import hashlib
+import shutil
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
 from openai import OpenAI
 
 import config
 from src.document_processor import DocumentProcessor
 from src.vector_store import VectorStoreManager
 from src.crew import DocumentRAGCrew
+from src.http_client import get_openai_client, openai_retry_interactive
 
 # Available OpenAI Models
 AVAILABLE_MODELS = {
@@ -27,6 +34,51 @@ AVAILABLE_MODELS = {
     "o1-preview": "o1-preview",
     "o1-mini": "o1-mini"
 }
+_MODEL_KEYS = tuple(AVAILABLE_MODELS.keys())
+_MODEL_INDEX = {k: i for i, k in enumerate(_MODEL_KEYS)}
+
+# Document viewer limits
+PREVIEW_CHUNK_BYTES = 256 * 1024
+TEXT_AREA_MAX_BYTES = 64 * 1024
+CSV_PREVIEW_ROWS = 1000
+
+# Kept byte-identical across calls so OpenAI prompt caching can reuse the prefix
+_REPHRASE_SYSTEM_PROMPT = """You are an expert query optimizer for a RAG system.
+Your task is to take a user's input and transform it into a highly effective, specific, and comprehensive search query for finding information in documents.
+
+CRITICAL INSTRUCTION:
+If the user provides a SHORT or VAGUE input (e.g., "Summarize", "Explain", "Key points"), you MUST expand it into a full, detailed instruction.
+
+EXAMPLES:
+Input: "Summarize"
+Output: "Please provide a comprehensive summary of the document, detailing the main topics, key arguments, and primary conclusions."
+
+Input: "Explain"
+Output: "Explain the core concepts and ideas presented in this document in detail, providing context and examples if available."
+
+Input: "Key points"
+Output: "What are the most important key points, takeaways, and critical information mentioned in this document?"
+
+Input: "Cost"
+Output: "What specific information does the document provide regarding costs, pricing, expenses, or financial implications?"
+
+Input: "How to fix deployment"
+Output: "What are the step-by-step instructions or solutions provided in the document for troubleshooting and fixing deployment issues?"
+
+Return ONLY the enhanced query. Do not add quotes or explanations."""
+
+# Canonical expansions for common vague inputs; these skip the rephrase LLM call
+_VAGUE_MAP = {
+    "summarize": "Please provide a comprehensive summary of the document, detailing the main topics, key arguments, and primary conclusions.",
+    "explain": "Explain the core concepts and ideas presented in this document in detail, providing context and examples if available.",
+    "key points": "What are the most important key points, takeaways, and critical information mentioned in this document?",
+    "cost": "What specific information does the document provide regarding costs, pricing, expenses, or financial implications?",
+}
+
+# Most recent chat messages rendered by default
+CHAT_HISTORY_WINDOW = 20
+
+PDF_IFRAME_TEMPLATE = '<iframe src="app/static/{}" width="100%" height="600" type="application/pdf"></iframe>'
 
 # Page configuration
 st.set_page_config(
@@ -36,215 +88,29 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Clean White Theme CSS
-st.markdown("""
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700;800&display=swap');
-    
-    html, body, [class*="css"] {
-        font-family: 'Inter', -apple-system, BlinkMacSystemFont, sans-serif;
-    }
-    
-    /* Ensure material icons use the correct font */
-    .material-icons {
-        font-family: 'Material Icons', sans-serif !important;
-    }
-    
-    .stApp {
-        background: #f8f9fc !important;
-    }
-    
-    .main .block-container {
-        padding: 1.5rem 2rem !important;
-        max-width: 1400px !important;
-    }
-    
-    /* Header Styles */
-    .main-header {
-        color: #5046e5 !important;
-        font-size: 2.2rem !important;
-        font-weight: 800 !important;
-        text-align: center;
-        margin-bottom: 0.25rem;
-    }
-    
-    .sub-header {
-        color: #666680 !important;
-        text-align: center;
-        font-size: 0.95rem !important;
-        margin-bottom: 0.25rem;
-    }
-    
-    .author-credit {
-        color: #888 !important;
-        text-align: center;
-        font-size: 0.8rem !important;
-        margin-bottom: 1rem;
-    }
-    
-    /* Sidebar */
-    section[data-testid="stSidebar"] {
-        background: #ffffff !important;
-        border-right: 1px solid #e5e7eb !important;
-        width: 400px !important;
-        min-width: 400px !important;
-    }
-    
-    section[data-testid="stSidebar"] h1,
-    section[data-testid="stSidebar"] h2,
-    section[data-testid="stSidebar"] h3 {
-        color: #1a1a2e !important;
-        font-weight: 600 !important;
-        font-size: 1rem !important;
-    }
-    
-    /* Metrics */
-    [data-testid="stMetric"] {
-        background: #ffffff !important;
-        border: 1px solid #e5e7eb !important;
-        border-radius: 10px !important;
-        padding: 0.75rem !important;
-    }
-    
-    [data-testid="stMetric"] label {
-        color: #666680 !important;
-        font-size: 0.7rem !important;
-        font-weight: 600 !important;
-        text-transform: uppercase !important;
-    }
-    
-    [data-testid="stMetric"] [data-testid="stMetricValue"] {
-        color: #5046e5 !important;
-        font-size: 1.5rem !important;
-        font-weight: 700 !important;
-    }
-    
-    /* Tabs */
-    .stTabs [data-baseweb="tab-list"] {
-        background: #ffffff !important;
-        border-radius: 8px !important;
-        padding: 0.25rem !important;
-        border: 1px solid #e5e7eb !important;
-        gap: 0.25rem !important;
-    }
-    
-    .stTabs [data-baseweb="tab"] {
-        color: #555566 !important;
-        font-weight: 500 !important;
-        border-radius: 6px !important;
-        padding: 0.5rem 1rem !important;
-        background: transparent !important;
-    }
-    
-    .stTabs [data-baseweb="tab"]:hover {
-        background: #f3f4f6 !important;
-    }
-    
-    .stTabs [aria-selected="true"] {
-        background: #5046e5 !important;
-        color: #ffffff !important;
-    }
-    
-    .stTabs [aria-selected="true"] p {
-        color: #ffffff !important;
-    }
-    
-    /* Buttons */
-    .stButton > button {
-        background: #5046e5 !important;
-        color: #ffffff !important;
-        border: none !important;
-        border-radius: 6px !important;
-        padding: 0.5rem 1rem !important;
-        font-weight: 600 !important;
-        font-size: 0.85rem !important;
-    }
-    
-    .stButton > button:hover {
-        background: #4338ca !important;
-        color: #ffffff !important;
-    }
-    
-    .stButton > button p {
-        color: #ffffff !important;
-    }
-    
-    /* File list buttons small */
-    .small-button > button {
-        padding: 0.25rem 0.5rem !important;
-        font-size: 0.75rem !important;
-        min-height: 0px !important;
-        height: auto !important;
-    }
-    
-    /* Chat messages */
-    [data-testid="stChatMessage"] {
-        background: #ffffff !important;
-        border: 1px solid #e5e7eb !important;
-        border-radius: 8px !important;
-        padding: 1rem !important;
-        margin: 0.5rem 0 !important;
-        box-shadow: 0 1px 2px rgba(0,0,0,0.05);
-    }
-    
-    /* Message Avatars */
-    .stChatMessageAvatar {
-        background-color: #e0e7ff !important;
-        color: #5046e5 !important;
-        font-size: 1.2rem !important;
-        border: 1px solid #c7d2fe !important;
-    }
-    
-    /* Source box */
-    .source-box {
-        background: #f8f9fc;
-        border: 1px solid #e5e7eb;
-        border-left: 3px solid #5046e5;
-        padding: 0.75rem;
-        margin: 0.5rem 0;
-        border-radius: 0 6px 6px 0;
-        color: #333344;
-    }
-    
-    /* Sidebar Alignment */
-    div[data-testid="column"] button {
-        margin: 0 auto;
-        display: block;
-    }
-    
-    /* Analytics Title Styling */
-    .analytics-title {
-        font-size: 1.1rem;
-        font-weight: 600;
-        color: #333;
-        margin-bottom: 0.5rem;
-    }
-    
-    /* Rephrase Box */
-    .rephrase-box {
-        background-color: #f0fdf4;
-        border: 1px solid #bbf7d0;
-        border-radius: 8px;
-        padding: 1rem;
-        margin-bottom: 1rem;
-        color: #166534;
-    }
-    .rephrase-label {
-        font-weight: 600;
-        font-size: 0.85rem;
-        color: #15803d;
-        margin-bottom: 0.25rem;
-    }
-    .rephrase-text {
-        font-size: 0.95rem;
-    }
-    
-    hr {
-        border-color: #e5e7eb !important;
-        margin: 1rem 0 !important;
-    }
-</style>
-""", unsafe_allow_html=True)
+# Clean White Theme CSS, kept in static/style.css and read once per process. It is
+# inlined rather than linked because Streamlit's static handler serves .css as
+# text/plain + nosniff, which browsers refuse to apply as a stylesheet. Like the
+# original inline block, the full stylesheet is still sent on every rerun; moving it
+# to a file only keeps it out of the Python source.
+_CSS = f"<style>\n{(config.STATIC_DIR / 'style.css').read_text(encoding='utf-8')}\n</style>"
+
+
+def _inject_css():
+    """Attach the app stylesheet."""
+    st.markdown(_CSS, unsafe_allow_html=True)
+
+
+@st.cache_resource(show_spinner=False)
+def get_document_processor() -> DocumentProcessor:
+    """Document processor shared by all sessions in this process."""
+    return DocumentProcessor()
+
+
+@st.cache_resource(show_spinner=False)
+def get_vector_store() -> VectorStoreManager:
+    """Milvus connection shared by all sessions in this process."""
+    return VectorStoreManager()
 
 
 def init_session_state():
@@ -254,8 +120,6 @@ def init_session_state():
     
     defaults = {
         "messages": [],
-        "document_processor": None,
-        "vector_store": None,
         "crew": None,
         "initialized": False,
         "selected_model": "gpt-4o",
@@ -267,18 +131,17 @@ def init_session_state():
         },
         "openai_client": None,
         "rephrase_query": "",
-        "show_rephrased": False
+        "show_rephrased": False,
+        "show_full_history": False
     }
     
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
     
-    if st.session_state.document_processor is None:
-        st.session_state.document_processor = DocumentProcessor()
-    
     if st.session_state.openai_client is None and config.OPENAI_API_KEY:
-        st.session_state.openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
+        # Reuses the process-wide connection pool shared with the agents
+        st.session_state.openai_client = get_openai_client()
 
 
 def initialize_services():
@@ -291,12 +154,13 @@ def initialize_services():
         
         try:
             with st.spinner("Connecting to Milvus..."):
-                st.session_state.vector_store = VectorStoreManager()
-                st.session_state.crew = DocumentRAGCrew(st.session_state.vector_store)
+                vector_store = get_vector_store()
+                # The crew stays per session (model selection) but shares the vector store
+                st.session_state.crew = DocumentRAGCrew(vector_store)
                 st.session_state.initialized = True
                 
                 # Hydrate analytics from DB once connected
-                stats = st.session_state.vector_store.get_collection_stats()
+                stats = vector_store.get_collection_stats()
                 st.session_state.analytics["total_chunks"] = stats.get("row_count", 0)
                 
             return True
@@ -318,204 +182,296 @@ def update_analytics(chunks_added=0, tokens_used=0, query_made=False):
     st.session_state.analytics["estimated_cost"] = embedding_cost + llm_cost
 
 
+@st.cache_data(ttl=3600, max_entries=256, show_spinner="Enhancing your query...")
+def _rephrase_cached(_client: OpenAI, model: str, query_key: str, api_key_fingerprint: str, _original: str) -> str:
+    """Call OpenAI to rephrase a query. Cached per (model, normalized query, API key).
+    
+    query_key is the normalized cache key; _original (unhashed) is the text sent to the
+    model, so casing such as "AWS" or "GDPR" is preserved.
+    """
+    response = openai_retry_interactive(_client.chat.completions.create)(
+        model=model,
+        messages=[
+            {
+                "role": "system",
+                "content": _REPHRASE_SYSTEM_PROMPT
+            },
+            {"role": "user", "content": _original}
+        ],
+        max_tokens=200,
+        temperature=0.3,
+        # Stable routing key so rephrase requests land on the same prompt cache
+        extra_body={"prompt_cache_key": "query-rephrase"}
+    )
+    return response.choices[0].message.content.strip()
+
+
 def rephrase_query_func(query: str) -> str:
     """Rephrase and expand query using OpenAI for better document retrieval."""
     if not query or not query.strip():
         st.warning("Please enter a query to rephrase.")
         return query
     
+    key = query.strip().lower()
+    if key in _VAGUE_MAP:
+        return _VAGUE_MAP[key]
+    
     try:
-        client = st.session_state.openai_client
-        if not client:
-            st.error("OpenAI client not initialized.")
-            return query
-        
-        with st.spinner("Enhancing your query..."):
-            response = client.chat.completions.create(
-                model=st.session_state.selected_model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """You are an expert query optimizer for a RAG system.
-Your task is to take a user's input and transform it into a highly effective, specific, and comprehensive search query for finding information in documents.
-
-CRITICAL INSTRUCTION:
-If the user provides a SHORT or VAGUE input (e.g., "Summarize", "Explain", "Key points"), you MUST expand it into a full, detailed instruction.
-
-EXAMPLES:
-Input: "Summarize"
-Output: "Please provide a comprehensive summary of the document, detailing the main topics, key arguments, and primary conclusions."
-
-Input: "Explain"
-Output: "Explain the core concepts and ideas presented in this document in detail, providing context and examples if available."
+        fingerprint = hashlib.sha256(config.OPENAI_API_KEY.encode("utf-8")).hexdigest()[:12]
+        return _rephrase_cached(
+            st.session_state.openai_client,
+            st.session_state.selected_model,
+            key,
+            fingerprint,
+            query.strip()
+        )
+    except Exception as e:
+        st.error(f"Rephrase failed: {str(e)}")
+        return query
 
-Input: "Key points"
-Output: "What are the most important key points, takeaways, and critical information mentioned in this document?"
 
-Input: "Cost"
-Output: "What specific information does the document provide regarding costs, pricing, expenses, or financial implications?"
+def _published_prefix(file_name: str) -> str:
+    """Stable file-name prefix of the static copies published for an upload."""
+    return hashlib.sha1(file_name.encode("utf-8")).hexdigest()[:16]
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _publish_pdf(path: str, mtime: float) -> str:
+    """Copy a PDF into the static directory once per (path, mtime) and return its file name."""
+    version = hashlib.sha1(f"{path}:{mtime}".encode("utf-8")).hexdigest()[:16]
+    name = f"{_published_prefix(Path(path).name)}-{version}.pdf"
+    target = config.STATIC_DIR / name
+    if not target.exists():
+        # Drop earlier versions of this upload; a hard link would otherwise keep
+        # the replaced file's data alive under static/
+        for stale in config.STATIC_DIR.glob(f"{_published_prefix(Path(path).name)}-*.pdf"):
+            stale.unlink(missing_ok=True)
+        # Hard-link when possible so no bytes are copied; fall back to a
+        # kernel-side copy (sendfile) that never buffers the PDF in Python
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+    return name
 
-Input: "How to fix deployment"
-Output: "What are the step-by-step instructions or solutions provided in the document for troubleshooting and fixing deployment issues?"
 
-Return ONLY the enhanced query. Do not add quotes or explanations."""
-                    },
-                    {"role": "user", "content": query}
-                ],
-                max_tokens=200,
-                temperature=0.3
-            )
-            rephrased = response.choices[0].message.content.strip()
-            return rephrased
-    except Exception as e:
-        st.error(f"Rephrase failed: {str(e)}")
-        return query
+def unpublish_pdf(file_name: Optional[str] = None):
+    """Remove the static preview copies of one upload, or of every upload when file_name is None."""
+    pattern = f"{_published_prefix(file_name)}-*.pdf" if file_name else "*.pdf"
+    for published in config.STATIC_DIR.glob(pattern):
+        published.unlink(missing_ok=True)
+    # Cached names may now point at removed files
+    _publish_pdf.clear()
 
 
 def get_pdf_display(file_path: str) -> str:
-    """Generate PDF display HTML using iframe."""
+    """Generate PDF display HTML using an iframe served from the static route."""
     try:
-        with open(file_path, "rb") as f:
-            pdf_bytes = f.read()
-        base64_pdf = base64.b64encode(pdf_bytes).decode('utf-8')
-        return f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="600" type="application/pdf"></iframe>'
+        static_name = _publish_pdf(file_path, Path(file_path).stat().st_mtime)
+        return PDF_IFRAME_TEMPLATE.format(static_name)
     except Exception as e:
         return f"<p>Error loading PDF: {str(e)}</p>"
 
 
-def render_document_viewer(file_path: str, file_name: str):
-    """Render document viewer."""
+def render_document_viewer(file_path: str, file_name: str, key_prefix: str = "viewer"):
+    """Render document viewer, loading large text files in bounded chunks."""
     path = Path(file_path)
     ext = path.suffix.lower()
     
     if ext == ".pdf":
         st.markdown(get_pdf_display(file_path), unsafe_allow_html=True)
-    elif ext in [".txt", ".csv"]:
+    elif ext == ".csv":
         try:
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read()
-            st.text_area(f"Content of {file_name}", content, height=500, disabled=True)
+            df = pd.read_csv(file_path, nrows=CSV_PREVIEW_ROWS)
+            st.dataframe(df, use_container_width=True)
+            st.caption(f"Showing up to the first {CSV_PREVIEW_ROWS} rows.")
+        except Exception as e:
+            st.error(f"Error reading file: {str(e)}")
+    elif ext == ".txt":
+        try:
+            offset_key = f"offset_{file_name}"
+            limit = st.session_state.get(offset_key, PREVIEW_CHUNK_BYTES)
+            with open(file_path, "rb") as f:
+                raw = f.read(limit)
+                has_more = bool(f.read(1))
+            content = raw.decode("utf-8", errors="ignore")
+            
+            if len(raw) <= TEXT_AREA_MAX_BYTES:
+                st.text_area(f"Content of {file_name}", content, height=500, disabled=True)
+            else:
+                st.code(content, language=None)
+            
+            if has_more:
+                st.button(
+                    "Append next 256 KB",
+                    key=f"{key_prefix}_more_{file_name}",
+                    on_click=lambda: st.session_state.update({offset_key: limit + PREVIEW_CHUNK_BYTES})
+                )
         except Exception as e:
             st.error(f"Error reading file: {str(e)}")
     else:
         st.warning(f"Preview not available for {ext} files.")
 
 
-def render_sidebar():
-    """Render sidebar with robust state and display logic."""
-    with st.sidebar:
-        st.markdown("### 📤 Document Upload")
-        
-        # Unique key for uploader to allow clearing if needed, though we rely on persistence check
-        uploaded_files = st.file_uploader(
-            "Upload documents",
-            type=["pdf", "txt", "csv"],
-            accept_multiple_files=True,
-            help="PDF, TXT, CSV"
-        )
-        
-        # Check for new files that aren't already processed
-        new_files = []
-        if uploaded_files:
-            existing_files = [f['name'] for f in st.session_state.document_processor.get_uploaded_files()]
-            for f in uploaded_files:
-                if f.name not in existing_files:
-                    new_files.append(f)
-        
-        if new_files:
-            if st.button("Process New Documents", use_container_width=True, type="primary"):
-                process_uploaded_files(new_files)
-        elif uploaded_files:
-            st.info("All uploaded files are already processed.")
-        
-        st.markdown("---")
-        
-        # Model Selection
-        st.markdown("### 🤖 Model Settings")
-        selected = st.selectbox(
-            "AI Model",
-            options=list(AVAILABLE_MODELS.keys()),
-            format_func=lambda x: AVAILABLE_MODELS[x],
-            index=list(AVAILABLE_MODELS.keys()).index(st.session_state.selected_model)
+@st.fragment
+def render_sidebar(files):
+    """Render sidebar with robust state and display logic.
+    
+    Runs as a fragment so uploads and model changes only rerun the sidebar;
+    actions that change the dashboard trigger a full app rerun.
+    """
+    st.markdown("### 📤 Document Upload")
+    
+    # Unique key for uploader to allow clearing if needed, though we rely on persistence check
+    uploaded_files = st.file_uploader(
+        "Upload documents",
+        type=["pdf", "txt", "csv"],
+        accept_multiple_files=True,
+        help="PDF, TXT, CSV"
+    )
+    
+    # Check for new files that aren't already processed
+    new_files = []
+    if uploaded_files:
+        # Built from main()'s directory scan, so uploads and deletes from other
+        # sessions are seen on the next full run
+        existing_names = {f["name"] for f in files}
+        for f in uploaded_files:
+            if f.name not in existing_names:
+                new_files.append(f)
+    
+    if new_files:
+        if st.button("Process New Documents", use_container_width=True, type="primary"):
+            process_uploaded_files(new_files)
+    elif uploaded_files:
+        st.info("All uploaded files are already processed.")
+    
+    st.markdown("---")
+    
+    # Model Selection
+    st.markdown("### 🤖 Model Settings")
+    selected = st.selectbox(
+        "AI Model",
+        options=_MODEL_KEYS,
+        format_func=lambda x: AVAILABLE_MODELS[x],
+        index=_MODEL_INDEX[st.session_state.selected_model]
+    )
+    if selected != st.session_state.selected_model:
+        st.session_state.selected_model = selected
+        if st.session_state.crew:
+            st.session_state.crew.set_model(selected)
+    
+    st.markdown("---")
+    
+    # Uploaded Files
+    st.markdown("### 📄 Uploaded Files")
+    
+    if files:
+        # One HTML table for the whole list; names are truncated by CSS
+        rows = "".join(
+            f"<tr><td class='fn' title='{html.escape(f['name'])}'>{html.escape(f['name'])}</td>"
+            f"<td class='fs'>{f['size']/1024:.1f} KB</td></tr>"
+            for f in files
         )
-        if selected != st.session_state.selected_model:
-            st.session_state.selected_model = selected
-            if st.session_state.crew:
-                st.session_state.crew.set_model(selected)
-        
-        st.markdown("---")
-        
-        # Uploaded Files
-        st.markdown("### 📄 Uploaded Files")
-        
-        files = st.session_state.document_processor.get_uploaded_files()
-        
-        if files:
-            for file in files:
-                col1, col2, col3 = st.columns([0.60, 0.20, 0.20])
-                with col1:
-                    name = file['name']
-                    if len(name) > 18:
-                        name = name[:15] + "..."
-                    st.markdown(f"<div style='padding-top: 5px;'><b>{name}</b></div>", unsafe_allow_html=True)
-                    st.caption(f"{file['size']/1024:.1f} KB")
-                with col2:
-                    st.button("👁", key=f"view_{file['name']}", help="View Document", use_container_width=True, on_click=lambda f=file: st.session_state.update({"preview_file": f}))
-                with col3:
-                    if st.button("🗑", key=f"del_{file['name']}", help="Delete Document", use_container_width=True):
-                        delete_file(file['name'])
-        else:
-            st.info("No documents uploaded.")
-        
-        st.markdown("---")
-        
-        # Knowledge Base
-        st.markdown("### 🧠 Knowledge Base")
-        # Use session state analytics for real-time consistency
-        chunks_count = st.session_state.analytics["total_chunks"]
-        st.metric("Indexed Chunks", chunks_count)
-        
-        st.markdown("---")
-        
-        # Actions
-        col1, col2 = st.columns(2)
+        st.markdown(f"<table class='file-table'>{rows}</table>", unsafe_allow_html=True)
+    
+        by_name = {f['name']: f for f in files}
+        col1, col2, col3 = st.columns([0.60, 0.20, 0.20])
         with col1:
-            if st.button("Clear All", use_container_width=True):
-                clear_all_data()
+            selected_file = st.selectbox("Document", list(by_name), key="sidebar_file", label_visibility="collapsed")
         with col2:
-            if st.button("Reset DB", use_container_width=True):
-                reset_milvus_collection()
-        
-        st.markdown("---")
-        st.caption("Created by Ishan Chakraborty\nMIT License 2024")
+            if st.button("👁", key="view_file", help="View Document", use_container_width=True):
+                # The preview lives in the main area, outside this fragment
+                st.session_state.preview_file = by_name[selected_file]
+                st.rerun()
+        with col3:
+            if st.button("🗑", key="del_file", help="Delete Document", use_container_width=True):
+                delete_file(selected_file)
+    else:
+        st.info("No documents uploaded.")
+    
+    st.markdown("---")
+    
+    # Knowledge Base
+    st.markdown("### 🧠 Knowledge Base")
+    # Use session state analytics for real-time consistency
+    chunks_count = st.session_state.analytics["total_chunks"]
+    st.metric("Indexed Chunks", chunks_count)
+    
+    st.markdown("---")
+    
+    # Actions
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Clear All", use_container_width=True):
+            clear_all_data()
+    with col2:
+        if st.button("Reset DB", use_container_width=True):
+            reset_milvus_collection()
+    
+    st.markdown("---")
+    st.caption("Created by Ishan Chakraborty\nMIT License 2024")
 
 
 def process_uploaded_files(files):
     """Process files with checks for existence."""
     if not files:
         return
-    processor = st.session_state.document_processor
-    vector_store = st.session_state.vector_store
+    processor = get_document_processor()
+    vector_store = get_vector_store()
     progress = st.progress(0)
     status = st.empty()
-    total = len(files)
-    chunks = 0
+    all_chunks = []
     
-    for i, file in enumerate(files):
-        status.text(f"Processing {file.name}...")
+    # Save serially (cheap disk writes), then parse files concurrently
+    paths = {}
+    for file in files:
         try:
-            # Save and process
-            path = processor.save_uploaded_file(file)
-            c = processor.process_file(path)
-            if c:
-                added = vector_store.add_documents(c)
-                chunks += added
-                update_analytics(chunks_added=added)
+            paths[processor.save_uploaded_file(file)] = file.name
         except Exception as e:
-            st.error(f"Error processing {file.name}: {e}")
-        progress.progress((i + 1) / total)
+            st.error(f"Error saving {file.name}: {e}")
+    
+    failed = []
+    indexed = []
+    if paths:
+        status.text(f"Processing {len(paths)} file(s)...")
+        with ThreadPoolExecutor(max_workers=min(4, len(paths))) as executor:
+            futures = {executor.submit(processor.process_file, path): name for path, name in paths.items()}
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    all_chunks.extend(future.result())
+                    indexed.append(futures[future])
+                except Exception as e:
+                    st.error(f"Error processing {futures[future]}: {e}")
+                    failed.append(futures[future])
+                progress.progress((i + 1) / len(futures))
     
-    status.success(f"Successfully processed {chunks} chunks from {len(files)} new file(s).")
+    chunks = 0
+    index_failed = False
+    if all_chunks:
+        status.text(f"Embedding {len(all_chunks)} chunks...")
+        try:
+            # All or nothing: on failure add_documents removes the rows it inserted
+            chunks = vector_store.add_documents(all_chunks)
+            update_analytics(chunks_added=chunks)
+        except Exception as e:
+            st.error(f"Error indexing documents: {e}")
+            failed.extend(indexed)
+            index_failed = True
+    
+    # Remove files that were not indexed so they are not shown as processed
+    # and can be uploaded again
+    for name in failed:
+        processor.delete_file(name)
+    
+    if index_failed:
+        # Nothing was indexed; skip the rerun so the error stays visible
+        status.empty()
+        progress.empty()
+        return
+    
+    # Files that failed to save never made it into paths
+    status.success(f"Successfully processed {chunks} chunks from {len(paths) - len(failed)} new file(s).")
     time.sleep(1.5)
     status.empty()
     progress.empty()
@@ -525,22 +481,19 @@ def process_uploaded_files(files):
 def delete_file(name):
     """Delete file robustly."""
     try:
-        processor = st.session_state.document_processor
-        vector_store = st.session_state.vector_store
+        processor = get_document_processor()
+        vector_store = get_vector_store()
         
-        if vector_store:
-            vector_store.delete_by_source(name)
+        # Adjust the optimistic counter instead of re-reading collection stats
+        removed = vector_store.delete_by_source(name)
+        update_analytics(chunks_added=-removed)
         
         if st.session_state.get("preview_file") and st.session_state.preview_file['name'] == name:
             del st.session_state.preview_file
             
         processor.delete_file(name)
+        unpublish_pdf(name)
         
-        # Update chunk count roughly if possible (re-fetch correct stats)
-        if vector_store:
-            stats = vector_store.get_collection_stats()
-            st.session_state.analytics["total_chunks"] = stats.get("row_count", 0)
-            
         st.rerun()
     except Exception as e:
         st.error(f"Error deleting file: {str(e)}")
@@ -549,15 +502,15 @@ def delete_file(name):
 def clear_all_data():
     """Clear all data and reset state."""
     try:
-        processor = st.session_state.document_processor
-        vector_store = st.session_state.vector_store
-        
-        if vector_store:
-            vector_store.clear_collection()
+        processor = get_document_processor()
+        vector_store = get_vector_store()
+        vector_store.clear_collection()
+        vector_store.clear_embedding_cache()
         
         files = processor.get_uploaded_files()
         for f in files:
             processor.delete_file(f["name"])
+        unpublish_pdf()
             
         st.session_state.messages = []
         st.session_state.analytics = {
@@ -577,25 +530,26 @@ def clear_all_data():
 def reset_milvus_collection():
     """Reset Milvus collection only."""
     try:
-        if st.session_state.vector_store:
-            st.session_state.vector_store.clear_collection()
-            
-            st.session_state.analytics["total_chunks"] = 0
-            
-            st.success("Database Flushed: Collection recreated empty.")
-            time.sleep(1)
-            st.rerun()
+        vector_store = get_vector_store()
+        vector_store.clear_collection()
+        vector_store.clear_embedding_cache()
+        
+        st.session_state.analytics["total_chunks"] = 0
+        
+        st.success("Database Flushed: Collection recreated empty.")
+        time.sleep(1)
+        st.rerun()
     except Exception as e:
         st.error(f"Error resetting DB: {str(e)}")
 
 
-def render_analytics():
+def render_analytics(files):
     """Render dashboard with live data."""
     a = st.session_state.analytics
     cols = st.columns(5)
     
     # Calculate documents lively
-    doc_count = len(st.session_state.document_processor.get_uploaded_files())
+    doc_count = len(files)
     
     # Chunks are from analytics state (optimistic)
     chunk_count = a["total_chunks"]
@@ -613,22 +567,37 @@ def render_analytics():
             st.metric(label, value)
 
 
+def render_sources_html(sources) -> str:
+    """Render all source boxes of a message as one HTML string."""
+    return "".join(
+        f"<div class=\"source-box\"><strong>{html.escape(src['source'])}</strong> (Page {src['page']})<br>"
+        f"<small>{html.escape(src.get('text', '')[:200])}...</small></div>"
+        for src in sources
+    )
+
+
+@st.fragment
 def render_chat():
-    """Render chat."""
-    for msg in st.session_state.messages:
+    """Render chat. Runs as a fragment so typing and rephrasing only rerun the chat."""
+    messages = st.session_state.messages
+    
+    # Only the latest messages are re-emitted on each rerun unless the user asks for all
+    hidden = 0
+    if not st.session_state.show_full_history:
+        hidden = max(0, len(messages) - CHAT_HISTORY_WINDOW)
+    if hidden:
+        st.caption(f"{hidden} earlier message(s) hidden.")
+        st.button("Show full history", on_click=lambda: st.session_state.update({"show_full_history": True}))
+    
+    for msg in messages[hidden:]:
         avatar = "👤" if msg["role"] == "user" else "🤖"
         
         with st.chat_message(msg["role"], avatar=avatar):
             st.markdown(msg["content"])
             if msg.get("sources"):
                 with st.expander("📚 View Sources"):
-                    for src in msg["sources"]:
-                        st.markdown(f"""
-                        <div class="source-box">
-                            <strong>{src['source']}</strong> (Page {src['page']})<br>
-                            <small>{src.get('text', '')[:200]}...</small>
-                        </div>
-                        """, unsafe_allow_html=True)
+                    sources_html = msg.get("sources_html") or render_sources_html(msg["sources"])
+                    st.markdown(sources_html, unsafe_allow_html=True)
     
     st.markdown("---")
     
@@ -657,7 +626,7 @@ def render_chat():
             if query_input:
                 new_q = rephrase_query_func(query_input)
                 st.session_state.rephrase_query = new_q
-                st.rerun()
+                st.rerun(scope="fragment")
             else:
                 st.warning("Enter text first")
 
@@ -666,52 +635,65 @@ def render_chat():
         if input_to_use:
             process_query(input_to_use)
             st.session_state.rephrase_query = ""
+            # Full rerun so the analytics dashboard picks up the new query
             st.rerun()
 
 
 def process_query(prompt):
-    """Process query."""
+    """Process query, streaming the answer into a chat bubble."""
     if not prompt: return
     
     st.session_state.messages.append({"role": "user", "content": prompt})
+    with st.chat_message("user", avatar="👤"):
+        st.markdown(prompt)
     
-    with st.spinner("Thinking..."):
-        try:
-            crew = st.session_state.crew
-            crew.set_model(st.session_state.selected_model)
-            res = crew.query(prompt)
-            
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": res["answer"],
-                "sources": res.get("sources", [])
-            })
-            
-            tok = int((len(prompt.split()) + len(res["answer"].split())) * 1.5)
-            update_analytics(tokens_used=tok, query_made=True)
-            st.rerun()
-        except Exception as e:
-            st.error(f"Error: {e}")
+    try:
+        crew = st.session_state.crew
+        crew.set_model(st.session_state.selected_model)
+        with st.spinner("Thinking..."):
+            res = crew.query_stream(prompt)
+        
+        with st.chat_message("assistant", avatar="🤖"):
+            answer = st.write_stream(res["answer"])
+        
+        sources = res.get("sources", [])
+        st.session_state.messages.append({
+            "role": "assistant",
+            "content": answer,
+            "sources": sources,
+            "sources_html": render_sources_html(sources)
+        })
+        
+        # ~4 characters per token heuristic
+        tok = (len(prompt) + len(answer)) // 4
+        update_analytics(tokens_used=tok, query_made=True)
+    except Exception as e:
+        st.error(f"Error: {e}")
 
 
 def main():
     init_session_state()
+    _inject_css()
     st.markdown('<h1 class="main-header">📚 Document Knowledge Retrieval</h1>', unsafe_allow_html=True)
     st.markdown('<p class="sub-header">Multi-Agent RAG with Milvus & OpenAI</p>', unsafe_allow_html=True)
     st.markdown('<p class="author-credit">Created by Ishan Chakraborty | MIT License</p>', unsafe_allow_html=True)
     
     if not initialize_services(): st.stop()
     
-    render_sidebar()
+    # One directory scan per run, shared by the sidebar, dashboard and tabs
+    files = get_document_processor().get_uploaded_files()
+    
+    with st.sidebar:
+        render_sidebar(files)
     
     st.markdown('<div class="analytics-title">📊 Analytics Dashboard</div>', unsafe_allow_html=True)
-    render_analytics()
+    render_analytics(files)
     st.markdown("---")
     
     if st.session_state.get("preview_file"):
         f = st.session_state.preview_file
         st.markdown(f"### 👁️ Preview: {f['name']}")
-        render_document_viewer(f['path'], f['name'])
+        render_document_viewer(f['path'], f['name'], key_prefix="preview")
         if st.button("Close Preview"):
             del st.session_state.preview_file
             st.rerun()
@@ -720,19 +702,18 @@ def main():
     tab1, tab2, tab3 = st.tabs(["💬 Chat", "📂 Documents", "ℹ️ About"])
     
     with tab1:
-        if not st.session_state.document_processor.get_uploaded_files():
+        if not files:
             st.info("👋 Welcome! Please upload documents in the sidebar to get started.")
         render_chat()
     
     with tab2:
         st.markdown("### 📂 Document Repository")
-        files = st.session_state.document_processor.get_uploaded_files()
         if files:
             sel = st.selectbox("Select document to view", [f['name'] for f in files])
             if sel:
                 for f in files:
                     if f['name'] == sel:
-                        render_document_viewer(f['path'], f['name'])
+                        render_document_viewer(f['path'], f['name'], key_prefix="repo")
         else:
             st.info("No documents available.")
             
@@ -20,14 +20,24 @@ load_dotenv(override=True)
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / "data"
 UPLOADS_DIR = DATA_DIR / "uploads"
+# Chunk embeddings persisted across restarts (see src/embedding_cache.py); capped at
+# EMBEDDING_CACHE_MAX_ENTRIES rows (~12 KB each for text-embedding-3-large)
+EMBEDDING_CACHE_PATH = DATA_DIR / "embeddings.sqlite3"
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "50000"))
+# Served by Streamlit at app/static/ (see .streamlit/config.toml)
+STATIC_DIR = BASE_DIR / "static"
 
 # Ensure directories exist
 UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+STATIC_DIR.mkdir(parents=True, exist_ok=True)
 
 # OpenAI Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini")
 OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large")
+# Embedding rate limits of the account; ingestion is throttled to stay under them
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "3000"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "1000000"))
 
 # Milvus / Zilliz Cloud Configuration
 MILVUS_URI = os.getenv("MILVUS_URI", "")
@@ -38,6 +48,10 @@ MILVUS_COLLECTION_NAME = os.getenv("MILVUS_COLLECTION_NAME", "document_knowledge
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
 
+# Retrieval: when positive, COSINE hits scoring below this are dropped before
+# reaching the LLM. Off by default; tune it against your own embedding scores.
+MIN_SIMILARITY_SCORE = float(os.getenv("MIN_SIMILARITY_SCORE", "0"))
+
 # Embedding dimensions for text-embedding-3-large
 EMBEDDING_DIMENSION = 3072
 
@@ -9,50 +9,132 @@ Copyright (c) 2024 Ishan Chakraborty
 ============================================================
 """
 from openai import OpenAI
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, AsyncIterator, ClassVar, Iterator, Optional, Tuple
 
 import config
+from src.http_client import get_async_openai_client, get_openai_client, openai_retry_interactive
+
+
+def format_chunk_context(retrieved_chunks: List[Dict[str, Any]]) -> str:
+    """Format retrieved chunks as a numbered, source-tagged context block."""
+    context_parts = []
+    for i, chunk in enumerate(retrieved_chunks):
+        context_parts.append(
+            f"[Source {i+1}: {chunk['source']}, Page {chunk.get('page', 'N/A')}]\n{chunk['text']}"
+        )
+    
+    return "\n\n---\n\n".join(context_parts)
 
 
 class Agent:
     """A simple agent class that wraps OpenAI API calls."""
     
-    def __init__(self, role: str, goal: str, backstory: str, model: Optional[str] = None):
+    # Shared by every agent (and the vector store) so they reuse one connection pool
+    _client: ClassVar[Optional[OpenAI]] = None
+    
+    def __init__(self, role: str, goal: str, backstory: str, instructions: str = "", model: Optional[str] = None):
         self.role = role
         self.goal = goal
         self.backstory = backstory
-        self.client = OpenAI(api_key=config.OPENAI_API_KEY)
+        self.instructions = instructions
+        # Built once and never interpolated per call, so every request from this
+        # agent starts with a byte-identical prefix that OpenAI can prompt-cache
+        self.system_prompt = self._build_system_prompt()
         self.model = model or config.OPENAI_MODEL_NAME
     
+    @classmethod
+    def _get_client(cls) -> OpenAI:
+        """Return the shared OpenAI client, creating it on first use."""
+        if Agent._client is None:
+            Agent._client = get_openai_client()
+        return Agent._client
+    
+    @openai_retry_interactive
+    def _create(self, **kwargs):
+        """Create a chat completion, retrying transient OpenAI errors."""
+        return self._get_client().chat.completions.create(**kwargs)
+    
+    @openai_retry_interactive
+    async def _acreate(self, **kwargs):
+        """Async variant of _create()."""
+        return await get_async_openai_client().chat.completions.create(**kwargs)
+    
     def set_model(self, model: str):
         """Update the model used by this agent."""
         self.model = model
     
-    def run(self, task: str, context: str = "") -> str:
-        """Execute a task using the agent's persona."""
-        system_prompt = f"""You are a {self.role}.
-
-Your goal: {self.goal}
-
-Background: {self.backstory}
-
-Always provide helpful, accurate, and well-structured responses."""
-
+    def _build_system_prompt(self) -> str:
+        """Build the static system prompt from the persona and standing instructions."""
+        parts = [
+            f"You are a {self.role}.",
+            f"Your goal: {self.goal}",
+            f"Background: {self.backstory}"
+        ]
+        if self.instructions:
+            parts.append(self.instructions)
+        parts.append("Always provide helpful, accurate, and well-structured responses.")
+        return "\n\n".join(parts)
+    
+    def _build_messages(self, task: str, context: str = "") -> List[Dict[str, str]]:
+        """Build the chat messages: static system prompt first, per-request data last."""
         user_message = task
         if context:
             user_message = f"{task}\n\nContext:\n{context}"
         
-        response = self.client.chat.completions.create(
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": user_message}
+        ]
+    
+    def run(self, task: str, context: str = "") -> str:
+        """Execute a task using the agent's persona."""
+        response = self._create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
+            messages=self._build_messages(task, context),
             temperature=0.7,
             max_tokens=2000
         )
         
         return response.choices[0].message.content
+    
+    async def arun(self, task: str, context: str = "") -> str:
+        """Async variant of run() using the shared async client."""
+        response = await self._acreate(
+            model=self.model,
+            messages=self._build_messages(task, context),
+            temperature=0.7,
+            max_tokens=2000
+        )
+        
+        return response.choices[0].message.content
+    
+    def run_stream(self, task: str, context: str = "") -> Iterator[str]:
+        """Execute a task and yield the response text as it is generated."""
+        stream = self._create(
+            model=self.model,
+            messages=self._build_messages(task, context),
+            temperature=0.7,
+            max_tokens=2000,
+            stream=True
+        )
+        
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    
+    async def arun_stream(self, task: str, context: str = "") -> AsyncIterator[str]:
+        """Async variant of run_stream()."""
+        stream = await self._acreate(
+            model=self.model,
+            messages=self._build_messages(task, context),
+            temperature=0.7,
+            max_tokens=2000,
+            stream=True
+        )
+        
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
 
 
 class RetrievalAgent(Agent):
@@ -65,30 +147,31 @@ class RetrievalAgent(Agent):
             backstory="""You are an expert at understanding user queries and finding the most 
             relevant information from a knowledge base. You excel at semantic search and 
             understanding context. You always strive to find the best matching documents 
-            that will help answer the user's question comprehensively."""
+            that will help answer the user's question comprehensively.""",
+            instructions="""When given a query and retrieved document chunks, your job is to:
+1. Identify which chunks are most relevant to the query
+2. Extract the key information that answers the question
+3. Note any gaps or missing information
+4. Organize the relevant information logically"""
         )
     
-    def analyze(self, query: str, retrieved_chunks: List[Dict[str, Any]]) -> str:
-        """Analyze retrieved chunks and identify the most relevant information."""
-        context_parts = []
-        for i, chunk in enumerate(retrieved_chunks):
-            context_parts.append(
-                f"[Source {i+1}: {chunk['source']}, Page {chunk.get('page', 'N/A')}]\n{chunk['text']}"
-            )
-        
-        context = "\n\n---\n\n".join(context_parts)
+    def _analysis_task(self, query: str, retrieved_chunks: List[Dict[str, Any]]) -> Tuple[str, str]:
+        """Build the analysis task prompt and its chunk context."""
+        context = format_chunk_context(retrieved_chunks)
         
         task = f"""Analyze the following retrieved document chunks to answer this query:
 
-Query: {query}
-
-Your job is to:
-1. Identify which chunks are most relevant to the query
-2. Extract the key information that answers the question
-3. Note any gaps or missing information
-4. Organize the relevant information logically"""
+Query: {query}"""
 
-        return self.run(task, context)
+        return task, context
+    
+    def analyze(self, query: str, retrieved_chunks: List[Dict[str, Any]]) -> str:
+        """Analyze retrieved chunks and identify the most relevant information."""
+        return self.run(*self._analysis_task(query, retrieved_chunks))
+    
+    async def aanalyze(self, query: str, retrieved_chunks: List[Dict[str, Any]]) -> str:
+        """Async variant of analyze()."""
+        return await self.arun(*self._analysis_task(query, retrieved_chunks))
 
 
 class ResponseAgent(Agent):
@@ -102,21 +185,8 @@ class ResponseAgent(Agent):
             information and presenting it in a clear, accessible way. You always cite your 
             sources and provide accurate information based on the retrieved documents. 
             You are careful to only provide information that is supported by the sources 
-            and clearly indicate when information might be incomplete or uncertain."""
-        )
-    
-    def synthesize(self, query: str, analysis: str, sources: List[Dict[str, Any]]) -> str:
-        """Synthesize the final response based on analysis."""
-        source_list = ", ".join([s['source'] for s in sources[:5]])
-        
-        task = f"""Based on the analysis provided, create a comprehensive response to the user's query.
-
-Query: {query}
-
-Analysis of retrieved documents:
-{analysis}
-
-Available sources: {source_list}
+            and clearly indicate when information might be incomplete or uncertain.""",
+            instructions="""Based on the analysis provided, create a comprehensive response to the user's query.
 
 Your response should:
 1. Directly answer the user's question
@@ -124,8 +194,36 @@ Your response should:
 3. Cite sources when mentioning specific information (e.g., "According to document.pdf...")
 4. Be clear and well-organized
 5. Acknowledge if the answer is incomplete or uncertain based on available information"""
+        )
+    
+    def _synthesis_task(self, query: str, analysis: str, sources: List[Dict[str, Any]]) -> str:
+        """Build the synthesis task prompt."""
+        source_list = ", ".join([s['source'] for s in sources[:5]])
+        
+        task = f"""Query: {query}
 
-        return self.run(task)
+Available sources: {source_list}
+
+Analysis of retrieved documents:
+{analysis}"""
+
+        return task
+    
+    def synthesize(self, query: str, analysis: str, sources: List[Dict[str, Any]]) -> str:
+        """Synthesize the final response based on analysis."""
+        return self.run(self._synthesis_task(query, analysis, sources))
+    
+    async def asynthesize(self, query: str, analysis: str, sources: List[Dict[str, Any]]) -> str:
+        """Async variant of synthesize()."""
+        return await self.arun(self._synthesis_task(query, analysis, sources))
+    
+    def synthesize_stream(self, query: str, analysis: str, sources: List[Dict[str, Any]]) -> Iterator[str]:
+        """Synthesize the final response, yielding text as it is generated."""
+        return self.run_stream(self._synthesis_task(query, analysis, sources))
+    
+    def asynthesize_stream(self, query: str, analysis: str, sources: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """Async variant of synthesize_stream()."""
+        return self.arun_stream(self._synthesis_task(query, analysis, sources))
 
 
 class AnalyzerAgent(Agent):
@@ -138,7 +236,12 @@ class AnalyzerAgent(Agent):
             backstory="""You are an expert at analyzing documents and extracting valuable 
             insights. You can identify key themes, important facts, and summarize complex 
             content effectively. You help users understand the overall content and structure 
-            of their documents."""
+            of their documents.""",
+            instructions="""When given a document, analyze it and provide a comprehensive summary covering:
+1. Main topics and themes
+2. Key facts and takeaways
+3. Brief overall summary
+4. Notable insights or important details"""
         )
     
     def analyze_document(self, document_texts: List[str], source_name: str) -> str:
@@ -150,12 +253,6 @@ class AnalyzerAgent(Agent):
 Document: {source_name}
 
 Content:
-{combined_text}
-
-Provide:
-1. Main topics and themes
-2. Key facts and takeaways
-3. Brief overall summary
-4. Notable insights or important details"""
+{combined_text}"""
 
         return self.run(task)
@@ -8,12 +8,29 @@ License: MIT License
 Copyright (c) 2024 Ishan Chakraborty
 ============================================================
 """
-from typing import List, Dict, Any, Optional
+import asyncio
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
 
-from src.agents import RetrievalAgent, ResponseAgent, AnalyzerAgent
+from src.agents import RetrievalAgent, ResponseAgent, AnalyzerAgent, format_chunk_context
+from src.semantic_cache import SemanticCache
 from src.vector_store import VectorStoreManager
 
 
+# Snippet lengths for source citations in query() and simple_query()
+SOURCE_PREVIEW_CHARS = 300
+SIMPLE_QUERY_PREVIEW_CHARS = 500
+
+NO_RESULTS_ANSWER = "I couldn't find any relevant information in the uploaded documents. Please make sure you've uploaded documents related to your query."
+
+
+def source_preview(result: Dict[str, Any], limit: int) -> str:
+    """Return a search hit's text cut to limit characters, with an ellipsis only when cut."""
+    text = result["text"]
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}..."
+
+
 class DocumentRAGCrew:
     """Orchestrates the multi-agent RAG workflow."""
     
@@ -22,6 +39,7 @@ class DocumentRAGCrew:
         self.retrieval_agent = RetrievalAgent()
         self.response_agent = ResponseAgent()
         self.analyzer_agent = AnalyzerAgent()
+        self.cache = SemanticCache()
         if model:
             self.set_model(model)
     
@@ -31,39 +49,210 @@ class DocumentRAGCrew:
         self.response_agent.set_model(model)
         self.analyzer_agent.set_model(model)
     
-    def query(self, user_query: str, top_k: int = 5) -> Dict[str, Any]:
-        """Process a user query through the RAG pipeline."""
-        # Step 1: Retrieve relevant documents
-        search_results = self.vector_store.search(user_query, top_k=top_k)
-        
-        if not search_results:
-            return {
-                "answer": "I couldn't find any relevant information in the uploaded documents. Please make sure you've uploaded documents related to your query.",
-                "sources": [],
-                "success": False
-            }
-        
-        # Step 2: Format sources
+    def _format_sources(self, search_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Build the source citations shown alongside an answer."""
+        # Kept in search rank order, no re-sorting needed
         sources = []
         for result in search_results:
             sources.append({
                 "source": result["source"],
                 "page": result.get("page", 0),
                 "score": result["score"],
-                "text": result["text"][:300] + "..." if len(result["text"]) > 300 else result["text"]
+                "text": source_preview(result, SOURCE_PREVIEW_CHARS)
             })
+        return sources
+    
+    def _cache_namespace(self, top_k: int, fast_mode: bool) -> Tuple[str, int, bool, int]:
+        """Cached answers are only valid for the same model, settings and collection contents."""
+        return (self.response_agent.model, top_k, fast_mode, self.vector_store.generation)
+    
+    def _lookup_cache(self, query_embedding: List[float], top_k: int, fast_mode: bool) -> Tuple[Tuple[str, int, bool, int], Optional[Dict[str, Any]]]:
+        """Return the cache namespace for this request and the cached result, if any."""
+        namespace = self._cache_namespace(top_k, fast_mode)
+        return namespace, self.cache.get(query_embedding, namespace)
+    
+    def _retrieve_and_analyze(self, user_query: str, query_embedding: List[float], top_k: int, fast_mode: bool) -> Optional[Tuple[List[Dict[str, Any]], str]]:
+        """Run retrieval and analysis, returning (sources, analysis) or None if nothing matched."""
+        # Step 1: Retrieve relevant documents
+        search_results = self.vector_store.search(query_embedding, top_k=top_k)
         
-        # Step 3: Retrieval agent analyzes the chunks
-        analysis = self.retrieval_agent.analyze(user_query, search_results)
+        if not search_results:
+            return None
+        
+        # Step 2: Format sources
+        sources = self._format_sources(search_results)
+        
+        # Step 3: Analyze the chunks. Milvus already ranks them, so fast mode formats
+        # them directly instead of asking the retrieval agent to re-prioritize
+        if fast_mode:
+            analysis = format_chunk_context(search_results)
+        else:
+            analysis = self.retrieval_agent.analyze(user_query, search_results)
+        
+        return sources, analysis
+    
+    async def _aretrieve_and_analyze(self, user_query: str, query_embedding: List[float], top_k: int, fast_mode: bool) -> Optional[Tuple[List[Dict[str, Any]], str]]:
+        """Async variant of _retrieve_and_analyze()."""
+        search_results = await self.vector_store.asearch(query_embedding, top_k=top_k)
+        
+        if not search_results:
+            return None
+        
+        sources = self._format_sources(search_results)
+        
+        if fast_mode:
+            analysis = format_chunk_context(search_results)
+        else:
+            analysis = await self.retrieval_agent.aanalyze(user_query, search_results)
+        
+        return sources, analysis
+    
+    def query(self, user_query: str, top_k: int = 5, fast_mode: bool = True) -> Dict[str, Any]:
+        """Process a user query through the RAG pipeline.
+        
+        With fast_mode (default) the retrieved chunks go straight to the response
+        agent; fast_mode=False adds the retrieval agent's LLM analysis pass.
+        """
+        # Embed once; the vector serves both the semantic cache and the Milvus search
+        query_embedding = self.vector_store.embed_query(user_query)
+        namespace, cached = self._lookup_cache(query_embedding, top_k, fast_mode)
+        if cached is not None:
+            return dict(cached)
+        
+        prepared = self._retrieve_and_analyze(user_query, query_embedding, top_k, fast_mode)
+        
+        if prepared is None:
+            return {
+                "answer": NO_RESULTS_ANSWER,
+                "sources": [],
+                "success": False
+            }
+        
+        sources, analysis = prepared
         
         # Step 4: Response agent synthesizes the final answer
         response = self.response_agent.synthesize(user_query, analysis, sources)
         
+        result = {
+            "answer": response,
+            "sources": sources,
+            "success": True
+        }
+        self.cache.put(query_embedding, result, namespace)
+        return dict(result)
+    
+    def query_stream(self, user_query: str, top_k: int = 5, fast_mode: bool = True) -> Dict[str, Any]:
+        """Process a user query, streaming the final answer.
+        
+        Retrieval and analysis run before returning; "answer" is an iterator
+        of text fragments from the response agent. Cache hits yield the stored
+        answer as a single fragment.
+        """
+        query_embedding = self.vector_store.embed_query(user_query)
+        namespace, cached = self._lookup_cache(query_embedding, top_k, fast_mode)
+        if cached is not None:
+            return {**cached, "answer": iter([cached["answer"]])}
+        
+        prepared = self._retrieve_and_analyze(user_query, query_embedding, top_k, fast_mode)
+        
+        if prepared is None:
+            return {
+                "answer": iter([NO_RESULTS_ANSWER]),
+                "sources": [],
+                "success": False
+            }
+        
+        sources, analysis = prepared
+        
+        def stream_and_cache():
+            parts = []
+            for part in self.response_agent.synthesize_stream(user_query, analysis, sources):
+                parts.append(part)
+                yield part
+            # Only fully streamed answers are cached
+            self.cache.put(query_embedding, {"answer": "".join(parts), "sources": sources, "success": True}, namespace)
+        
         return {
+            "answer": stream_and_cache(),
+            "sources": sources,
+            "success": True
+        }
+    
+    async def aquery(self, user_query: str, top_k: int = 5, fast_mode: bool = True) -> Dict[str, Any]:
+        """Async variant of query(); run it on the shared loop via src.http_client.run_async."""
+        query_embedding = await self.vector_store.aembed_query(user_query)
+        namespace, cached = self._lookup_cache(query_embedding, top_k, fast_mode)
+        if cached is not None:
+            return dict(cached)
+        
+        prepared = await self._aretrieve_and_analyze(user_query, query_embedding, top_k, fast_mode)
+        
+        if prepared is None:
+            return {
+                "answer": NO_RESULTS_ANSWER,
+                "sources": [],
+                "success": False
+            }
+        
+        sources, analysis = prepared
+        response = await self.response_agent.asynthesize(user_query, analysis, sources)
+        
+        result = {
             "answer": response,
             "sources": sources,
             "success": True
         }
+        self.cache.put(query_embedding, result, namespace)
+        return dict(result)
+    
+    async def aquery_stream(self, user_query: str, top_k: int = 5, fast_mode: bool = True) -> Dict[str, Any]:
+        """Async variant of query_stream(); "answer" is an async iterator of text fragments.
+        
+        Only the response synthesis is streamed; retrieval and analysis complete first.
+        """
+        query_embedding = await self.vector_store.aembed_query(user_query)
+        namespace, cached = self._lookup_cache(query_embedding, top_k, fast_mode)
+        
+        async def single(text: str) -> AsyncIterator[str]:
+            yield text
+        
+        if cached is not None:
+            return {**cached, "answer": single(cached["answer"])}
+        
+        prepared = await self._aretrieve_and_analyze(user_query, query_embedding, top_k, fast_mode)
+        
+        if prepared is None:
+            return {
+                "answer": single(NO_RESULTS_ANSWER),
+                "sources": [],
+                "success": False
+            }
+        
+        sources, analysis = prepared
+        
+        async def stream_and_cache() -> AsyncIterator[str]:
+            parts = []
+            async for part in self.response_agent.asynthesize_stream(user_query, analysis, sources):
+                parts.append(part)
+                yield part
+            # Only fully streamed answers are cached
+            self.cache.put(query_embedding, {"answer": "".join(parts), "sources": sources, "success": True}, namespace)
+        
+        return {
+            "answer": stream_and_cache(),
+            "sources": sources,
+            "success": True
+        }
+    
+    async def aquery_many(self, queries: List[str], top_k: int = 5, concurrency: int = 8, fast_mode: bool = True) -> List[Dict[str, Any]]:
+        """Answer several independent queries concurrently, returning results in input order."""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run_one(user_query: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.aquery(user_query, top_k=top_k, fast_mode=fast_mode)
+        
+        return await asyncio.gather(*[run_one(q) for q in queries])
     
     def analyze_document(self, document_chunks: List[Any], source_name: str) -> str:
         """Analyze a newly uploaded document."""
@@ -90,7 +279,7 @@ class DocumentRAGCrew:
                 "source": result["source"],
                 "page": result.get("page", 0),
                 "score": result["score"],
-                "text": result["text"][:500] + "..." if len(result["text"]) > 500 else result["text"]
+                "text": source_preview(result, SIMPLE_QUERY_PREVIEW_CHARS)
             })
             context_parts.append(result["text"])
         
@@ -8,8 +8,10 @@ Copyright (c) 2024 Ishan Chakraborty
 ============================================================
 """
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader, TextLoader, CSVLoader
@@ -18,6 +20,10 @@ from langchain_core.documents import Document
 import config
 
 
+def _process_file_worker(file_path: str, chunk_size: int, chunk_overlap: int) -> List[Document]:
+    """Load and chunk one file in a worker process."""
+    return DocumentProcessor(chunk_size, chunk_overlap).process_file(file_path)
+
 
 class DocumentProcessor:
     """Handles document loading, chunking, and text extraction."""
@@ -77,27 +83,47 @@ class DocumentProcessor:
         chunks = self.chunk_documents(documents)
         return chunks
     
+    def _iter_directory_files(self, path: Path) -> Iterator[Path]:
+        """Yield every supported file in a directory."""
+        for extension in config.SUPPORTED_EXTENSIONS:
+            yield from path.glob(f"*{extension}")
+    
     def process_directory(self, directory_path: str) -> List[Document]:
         """Process all supported files in a directory."""
-        all_chunks = []
-        path = Path(directory_path)
+        files = [str(fp) for fp in self._iter_directory_files(Path(directory_path))]
+        if not files:
+            return []
         
-        for extension in config.SUPPORTED_EXTENSIONS:
-            for file_path in path.glob(f"*{extension}"):
+        # PDF parsing is CPU-bound pure Python, so spread files over processes
+        chunks_by_file: Dict[str, List[Document]] = {}
+        max_workers = min(os.cpu_count() or 1, len(files))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_process_file_worker, fp, self.chunk_size, self.chunk_overlap): fp
+                for fp in files
+            }
+            for future in as_completed(futures):
+                file_path = futures[future]
                 try:
-                    chunks = self.process_file(str(file_path))
-                    all_chunks.extend(chunks)
+                    chunks_by_file[file_path] = future.result()
                 except Exception as e:
                     print(f"Error processing {file_path}: {e}")
         
-        return all_chunks
+        # Keep directory order so ingestion is deterministic
+        return list(chain.from_iterable(
+            chunks_by_file[fp] for fp in files if fp in chunks_by_file
+        ))
     
     def save_uploaded_file(self, uploaded_file) -> str:
         """Save an uploaded file to the uploads directory and return the path."""
         file_path = config.UPLOADS_DIR / uploaded_file.name
         
-        with open(file_path, "wb") as f:
+        # Write a new file and swap it in rather than truncating in place, so a
+        # published preview hard-linked to the old file is never rewritten
+        tmp_path = file_path.with_name(f".{file_path.name}.tmp")
+        with open(tmp_path, "wb") as f:
             f.write(uploaded_file.getbuffer())
+        os.replace(tmp_path, file_path)
         
         return str(file_path)
     
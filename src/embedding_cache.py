@@ -0,0 +1,95 @@
+"""
+Persistent embedding cache backed by SQLite, keyed by chunk content hash.
+
+============================================================
+Created by: Ishan Chakraborty
+License: MIT License
+Copyright (c) 2024 Ishan Chakraborty
+============================================================
+"""
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """On-disk store of embeddings keyed by (model, blake2b(text)).
+    
+    Survives restarts, so re-uploading a document (or one sharing sections with an
+    earlier upload) does not embed the same chunk text again. Vectors are stored as
+    raw float32 bytes. At most max_entries rows are kept; the least recently written
+    ones are dropped first. Deleting a single document keeps its vectors (a re-upload
+    reuses them); clear() empties the store.
+    """
+    
+    def __init__(self, path: Path, max_entries: int = 50000):
+        self.max_entries = max_entries
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, digest BLOB NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, digest))"
+            )
+            self._conn.commit()
+    
+    @staticmethod
+    def _digest(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Return the stored embedding for each text, or None where there is none."""
+        if not texts:
+            return []
+        digests = [self._digest(text) for text in texts]
+        found = {}
+        # Stay well under SQLite's bound-parameter limit
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT digest, vector FROM embeddings WHERE model = ? AND digest IN ({placeholders})",
+                    [model, *batch]
+                ).fetchall()
+            found.update(rows)
+        return [
+            np.frombuffer(found[digest], dtype=np.float32).tolist() if digest in found else None
+            for digest in digests
+        ]
+    
+    def put_many(self, model: str, texts: Sequence[str], embeddings: Sequence[List[float]]):
+        """Store embeddings for texts, replacing any existing entries."""
+        rows = [
+            (model, self._digest(text), np.asarray(embedding, dtype=np.float32).tobytes())
+            for text, embedding in zip(texts, embeddings)
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, digest, vector) VALUES (?, ?, ?)",
+                rows
+            )
+            # REPLACE assigns a fresh rowid, so the lowest rowids are the oldest writes
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN ("
+                "SELECT rowid FROM embeddings ORDER BY rowid "
+                "LIMIT MAX((SELECT COUNT(*) FROM embeddings) - ?, 0))",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+    
+    def clear(self):
+        """Remove every stored embedding and shrink the database file."""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._conn.execute("VACUUM")
@@ -0,0 +1,113 @@
+"""
+Shared HTTP connection pools for OpenAI clients.
+
+============================================================
+Created by: Ishan Chakraborty
+License: MIT License
+Copyright (c) 2024 Ishan Chakraborty
+============================================================
+"""
+import asyncio
+import threading
+import weakref
+from typing import Awaitable, Optional, TypeVar
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+try:
+    from openai import DefaultAioHttpClient
+except ImportError:  # openai older than 1.89 (see requirements.txt)
+    DefaultAioHttpClient = None
+
+import config
+
+
+T = TypeVar("T")
+
+# One keep-alive pool for the whole process, so agents, embeddings and query
+# rephrasing reuse TCP/TLS connections instead of each opening their own.
+HTTP_CLIENT = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30),
+    timeout=60.0
+)
+
+def _is_transient(exc: BaseException) -> bool:
+    """Rate limits, dropped connections and 5xx errors are worth retrying.
+    
+    An exhausted quota is also reported as a 429 but will not clear by waiting.
+    """
+    if isinstance(exc, openai.RateLimitError):
+        return getattr(exc, "code", None) != "insufficient_quota"
+    return isinstance(exc, (openai.APIConnectionError, openai.InternalServerError))
+
+
+# Retry policies for OpenAI calls: transient errors back off exponentially with
+# jitter instead of failing outright. Both work on sync and async functions, and
+# the clients below disable the SDK's own retries so the two layers do not multiply.
+# openai_retry suits background work such as ingestion, where riding out a rate
+# limit beats aborting the whole upload; interactive calls use
+# openai_retry_interactive so a user waits seconds, not a minute, for an error.
+openai_retry = retry(
+    wait=wait_random_exponential(multiplier=1, max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+openai_retry_interactive = retry(
+    wait=wait_random_exponential(multiplier=0.5, max=4),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+
+_sync_client: Optional[OpenAI] = None
+_sync_client_lock = threading.Lock()
+
+# Async clients are bound to the event loop they run on, so keep one per loop.
+# Code in this app runs coroutines on a single background loop (see run_async),
+# which therefore shares one aiohttp session across all agents and embeddings.
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = weakref.WeakKeyDictionary()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def get_openai_client() -> OpenAI:
+    """Return the process-wide sync OpenAI client, created on first use."""
+    global _sync_client
+    with _sync_client_lock:
+        if _sync_client is None:
+            _sync_client = OpenAI(api_key=config.OPENAI_API_KEY, http_client=HTTP_CLIENT, max_retries=0)
+        return _sync_client
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """Return the async OpenAI client for the running event loop (aiohttp transport when available)."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        http_client = DefaultAioHttpClient() if DefaultAioHttpClient is not None else None
+        client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, http_client=http_client, max_retries=0)
+        _async_clients[loop] = client
+    return client
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Start the shared background event loop on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openai-async-loop", daemon=True).start()
+        return _loop
+
+
+def run_async(coro: Awaitable[T]) -> T:
+    """Run a coroutine on the shared background event loop and block until it finishes.
+    
+    Safe to call from any thread, including Streamlit script threads.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
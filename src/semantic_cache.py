@@ -0,0 +1,81 @@
+"""
+Semantic cache for RAG answers, keyed by query embeddings.
+
+============================================================
+Created by: Ishan Chakraborty
+License: MIT License
+Copyright (c) 2024 Ishan Chakraborty
+============================================================
+"""
+import threading
+import time
+from typing import Any, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """In-process cache that returns a stored answer for queries with a similar embedding.
+    
+    Entries are grouped by a namespace (e.g. model and collection version) so an
+    answer is only reused under the same conditions it was produced.
+    """
+    
+    def __init__(self, threshold: float = 0.92, ttl: float = 3600.0, max_entries: int = 256):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None  # one L2-normalized row per entry
+        self._entries: List[Tuple[Hashable, float, Any]] = []  # (namespace, expires_at, value)
+    
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def _drop(self, keep: np.ndarray):
+        """Keep only the entries selected by a boolean mask."""
+        self._entries = [entry for entry, k in zip(self._entries, keep) if k]
+        self._vectors = self._vectors[keep] if self._entries else None
+    
+    def get(self, embedding: List[float], namespace: Hashable = None) -> Optional[Any]:
+        """Return the cached value for the most similar query above the threshold, if any."""
+        with self._lock:
+            if not self._entries:
+                return None
+            
+            now = time.monotonic()
+            expired = np.array([expires_at <= now for _, expires_at, _ in self._entries])
+            if expired.any():
+                self._drop(~expired)
+                if not self._entries:
+                    return None
+            
+            # Cosine similarity against every cached query, best first
+            scores = self._vectors @ self._normalize(embedding)
+            for i in np.argsort(-scores):
+                if scores[i] < self.threshold:
+                    break
+                entry_namespace, _, value = self._entries[i]
+                if entry_namespace == namespace:
+                    return value
+            return None
+    
+    def put(self, embedding: List[float], value: Any, namespace: Hashable = None):
+        """Store a value for a query embedding, evicting the oldest entry when full."""
+        row = self._normalize(embedding)[np.newaxis, :]
+        with self._lock:
+            self._entries.append((namespace, time.monotonic() + self.ttl, value))
+            self._vectors = row if self._vectors is None else np.vstack([self._vectors, row])
+            if len(self._entries) > self.max_entries:
+                keep = np.ones(len(self._entries), dtype=bool)
+                keep[0] = False
+                self._drop(keep)
+    
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries = []
+            self._vectors = None
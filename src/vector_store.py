@@ -7,12 +7,72 @@ License: MIT License
 Copyright (c) 2024 Ishan Chakraborty
 ============================================================
 """
-from typing import List, Dict, Any, Optional
-from openai import OpenAI
+import asyncio
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List, Dict, Any, Hashable, Optional, Tuple, Union
+from aiolimiter import AsyncLimiter
 from pymilvus import MilvusClient, DataType, FieldSchema, CollectionSchema
 from langchain_core.documents import Document
 
 import config
+from src.embedding_cache import EmbeddingCache
+from src.http_client import get_async_openai_client, get_openai_client, openai_retry, openai_retry_interactive, run_async
+
+
+class _EmbeddingLRU:
+    """Thread-safe LRU of embeddings keyed by (model, text).
+    
+    Vectors are stored as float32 arrays (~12 KB for 3072 dims) rather than
+    lists of Python floats, which would be roughly eight times larger.
+    """
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, array]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Hashable) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._data.get(key)
+            if vector is None:
+                return None
+            self._data.move_to_end(key)
+        return vector.tolist()
+    
+    def put(self, key: Hashable, embedding: List[float]):
+        vector = array("f", embedding)
+        with self._lock:
+            self._data[key] = vector
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# Exact-match cache of query embeddings shared by all VectorStoreManager instances;
+# repeated queries (UI retries, identical questions) skip the OpenAI round trip.
+# Chunk embeddings from ingestion bypass it and go to the on-disk store below.
+_EMBEDDING_CACHE = _EmbeddingLRU(maxsize=4096)
+
+# Persistent store for chunk embeddings (ingestion only), so re-uploaded or shared
+# chunks are never re-embedded
+_EMBEDDING_STORE = EmbeddingCache(config.EMBEDDING_CACHE_PATH, config.EMBEDDING_CACHE_MAX_ENTRIES)
+
+# Client-side token buckets for the embedding endpoint, sized from the account limits.
+# Concurrent ingestion batches wait here instead of bursting into 429s.
+_EMBEDDING_RPM_LIMITER = AsyncLimiter(config.OPENAI_RPM, 60)
+_EMBEDDING_TPM_LIMITER = AsyncLimiter(config.OPENAI_TPM, 60)
+
+
+async def _throttle_embeddings(texts: List[str]):
+    """Wait for request and token budget before sending an embedding request."""
+    # Rough token estimate (4 chars per token); capped because a single acquire
+    # may not exceed the bucket size
+    tokens = min(max(sum(len(text) for text in texts) // 4, 1), config.OPENAI_TPM)
+    await _EMBEDDING_RPM_LIMITER.acquire()
+    await _EMBEDDING_TPM_LIMITER.acquire(tokens)
 
 
 class VectorStoreManager:
@@ -20,10 +80,12 @@ class VectorStoreManager:
     
     def __init__(self):
         self.client = None
-        self.openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
+        self.openai_client = get_openai_client()
         self.collection_name = config.MILVUS_COLLECTION_NAME
         self.embedding_model = config.OPENAI_EMBEDDING_MODEL
         self.embedding_dimension = config.EMBEDDING_DIMENSION
+        # Bumped on every write so caches built on search results can tell they are stale
+        self.generation = 0
         self._connect()
     
     def _connect(self):
@@ -44,61 +106,210 @@ class VectorStoreManager:
                 auto_id=True
             )
     
-    def get_embedding(self, text: str) -> List[float]:
-        """Generate embedding for a text using OpenAI."""
-        response = self.openai_client.embeddings.create(
-            model=self.embedding_model,
-            input=text
-        )
-        return response.data[0].embedding
+    def _lookup_cached(self, texts: List[str], persist: bool = False) -> Tuple[List[Optional[List[float]]], List[int]]:
+        """Look texts up in the cache, returning per-text results and the indices that missed.
+        
+        Query embeddings use the in-memory LRU; chunk embeddings (persist=True) use the
+        on-disk store only, so a large upload cannot evict cached queries.
+        """
+        if persist:
+            results = _EMBEDDING_STORE.get_many(self.embedding_model, texts)
+        else:
+            results = [_EMBEDDING_CACHE.get((self.embedding_model, text)) for text in texts]
+        misses = [i for i, result in enumerate(results) if result is None]
+        return results, misses
     
-    def get_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings for multiple texts."""
-        response = self.openai_client.embeddings.create(
-            model=self.embedding_model,
-            input=texts
-        )
+    def _store_cached(self, texts: List[str], results: List[Optional[List[float]]], misses: List[int], embeddings: List[List[float]], persist: bool = False) -> List[List[float]]:
+        """Fill missed slots with fresh embeddings and remember them in the LRU, or on disk when persist."""
+        for i, embedding in zip(misses, embeddings):
+            results[i] = embedding
+        if persist:
+            _EMBEDDING_STORE.put_many(self.embedding_model, [texts[i] for i in misses], embeddings)
+        else:
+            for i, embedding in zip(misses, embeddings):
+                _EMBEDDING_CACHE.put((self.embedding_model, texts[i]), embedding)
+        return results
+    
+    @openai_retry_interactive
+    def _request_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Call the OpenAI embeddings endpoint, retrying transient errors (query path, short backoff)."""
+        response = self.openai_client.embeddings.create(model=self.embedding_model, input=texts)
         return [item.embedding for item in response.data]
     
-    def add_documents(self, documents: List[Document]) -> int:
-        """Add documents to the vector store."""
-        if not documents:
-            return 0
-        
-        # Extract texts and metadata
-        texts = [doc.page_content for doc in documents]
-        
-        # Generate embeddings in batches
-        batch_size = 100
-        all_embeddings = []
-        
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            embeddings = self.get_embeddings_batch(batch)
-            all_embeddings.extend(embeddings)
+    @openai_retry
+    async def _arequest_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Async variant of _request_embeddings() for ingestion: throttled to the account's rate limits, with the longer backoff."""
+        await _throttle_embeddings(texts)
+        response = await get_async_openai_client().embeddings.create(model=self.embedding_model, input=texts)
+        return [item.embedding for item in response.data]
+    
+    def get_embedding(self, text: str) -> List[float]:
+        """Generate embedding for a text using OpenAI."""
+        return self.get_embeddings_batch([text])[0]
+    
+    def get_embeddings_batch(self, texts: List[str], persist: bool = False) -> List[List[float]]:
+        """Generate embeddings for multiple texts, calling OpenAI only for uncached ones.
         
-        # Prepare data for Milvus
-        data = []
-        for i, doc in enumerate(documents):
-            data.append({
-                "vector": all_embeddings[i],
+        persist=True uses the on-disk cache instead of the in-memory LRU; ingestion sets
+        it for chunk texts, while query embeddings stay in the LRU only.
+        """
+        results, misses = self._lookup_cached(texts, persist)
+        if misses:
+            embeddings = self._request_embeddings([texts[i] for i in misses])
+            self._store_cached(texts, results, misses, embeddings, persist)
+        return results
+    
+    async def aget_embedding(self, text: str) -> List[float]:
+        """Async variant of get_embedding()."""
+        return (await self.aget_embeddings_batch([text]))[0]
+    
+    async def aget_embeddings_batch(self, texts: List[str], persist: bool = False) -> List[List[float]]:
+        """Async variant of get_embeddings_batch()."""
+        if persist:
+            # SQLite I/O is blocking; keep it off the shared event loop
+            results, misses = await asyncio.to_thread(self._lookup_cached, texts, True)
+        else:
+            results, misses = self._lookup_cached(texts)
+        if misses:
+            embeddings = await self._arequest_embeddings([texts[i] for i in misses])
+            if persist:
+                await asyncio.to_thread(self._store_cached, texts, results, misses, embeddings, True)
+            else:
+                self._store_cached(texts, results, misses, embeddings)
+        return results
+    
+    def _to_records(self, documents: List[Document], embeddings: List[List[float]]) -> List[Dict[str, Any]]:
+        """Build Milvus insert records for documents and their embeddings."""
+        return [
+            {
+                "vector": embedding,
                 "text": doc.page_content[:65535],  # Milvus varchar limit
                 "source": doc.metadata.get("source", "unknown"),
                 "page": doc.metadata.get("page", 0),
                 "chunk_index": doc.metadata.get("chunk_index", 0)
-            })
+            }
+            for doc, embedding in zip(documents, embeddings)
+        ]
+    
+    @staticmethod
+    def _group_by_text(documents: List[Document]) -> List[List[Document]]:
+        """Group documents with identical chunk text, preserving first-seen order.
         
-        # Insert into Milvus
-        self.client.insert(
-            collection_name=self.collection_name,
-            data=data
-        )
+        Boilerplate (headers, footers, license blocks) repeats across chunks and files;
+        each group is embedded once and its vector shared by every document in it.
+        """
+        groups: Dict[bytes, List[Document]] = {}
+        for doc in documents:
+            key = hashlib.blake2b(doc.page_content.encode("utf-8"), digest_size=16).digest()
+            groups.setdefault(key, []).append(doc)
+        return list(groups.values())
+    
+    async def _aadd_documents(self, documents: List[Document], max_concurrency: int, batch_size: int = 100) -> int:
+        """Embed and insert documents as a pipeline, overlapping embedding calls with Milvus inserts."""
+        groups = self._group_by_text(documents)
+        batches = [groups[i:i + batch_size] for i in range(0, len(groups), batch_size)]
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # Holds embedded batches waiting for insert; with the semaphore this bounds
+        # memory to roughly max_concurrency + 4 batches instead of the whole upload
+        queue: asyncio.Queue = asyncio.Queue(maxsize=4)
+        
+        async def embed(batch: List[List[Document]]):
+            async with semaphore:
+                embeddings = await self.aget_embeddings_batch([group[0].page_content for group in batch], persist=True)
+                # Every document still gets its own row; duplicates share the vector
+                batch_docs = [doc for group in batch for doc in group]
+                batch_embeddings = [embedding for group, embedding in zip(batch, embeddings) for _ in group]
+                await queue.put(self._to_records(batch_docs, batch_embeddings))
+        
+        async def produce():
+            tasks = [asyncio.create_task(embed(batch)) for batch in batches]
+            try:
+                await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                # The consumer failed; nothing is left to drain the queue
+                for task in tasks:
+                    task.cancel()
+                raise
+            except Exception:
+                for task in tasks:
+                    task.cancel()
+                await queue.put(None)
+                raise
+            await queue.put(None)
+        
+        producer = asyncio.create_task(produce())
+        inserted = 0
+        inserted_ids: List[Any] = []
+        try:
+            while (records := await queue.get()) is not None:
+                # pymilvus is synchronous, so inserts run in a worker thread
+                result = await asyncio.to_thread(self.client.insert, collection_name=self.collection_name, data=records)
+                # Newer pymilvus returns {"insert_count": n, "ids": [...]}, older versions a list of primary keys
+                inserted_ids.extend(result.get("ids", []) if isinstance(result, dict) else result or [])
+                inserted += len(records)
+            # Surface embedding errors once the rows already embedded are in
+            await producer
+        except BaseException:
+            producer.cancel()
+            # All or nothing: drop the rows this call inserted so a failed upload
+            # leaves no half-indexed files behind
+            await self._adelete_ids(inserted_ids)
+            raise
+        finally:
+            if inserted:
+                self.generation += 1
         
-        return len(data)
+        return inserted
     
-    def search(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        """Search for similar documents."""
-        query_embedding = self.get_embedding(query)
+    async def _adelete_ids(self, ids: List[Any], batch_size: int = 1000):
+        """Best-effort delete of rows by primary key, used to roll back a failed ingestion."""
+        try:
+            for i in range(0, len(ids), batch_size):
+                await asyncio.to_thread(self.client.delete, collection_name=self.collection_name, ids=ids[i:i + batch_size])
+        except Exception as e:
+            print(f"Error rolling back inserted documents: {e}")
+    
+    def add_documents(self, documents: List[Document], max_concurrency: int = 8) -> int:
+        """Add documents to the vector store.
+        
+        Embedding batches are issued concurrently, with at most max_concurrency requests
+        in flight to stay within the account's rate limits, and each batch is inserted
+        into Milvus as soon as it is embedded. Identical chunk texts are embedded only
+        once; each document is still stored as its own row. If any batch fails, the rows
+        already inserted by this call are deleted again before the error is re-raised.
+        For large offline re-ingestion jobs the OpenAI Batch API (50% cost, async
+        delivery) would be the natural next step; interactive uploads keep using the
+        synchronous endpoint.
+        """
+        if not documents:
+            return 0
+        
+        return run_async(self._aadd_documents(documents, max_concurrency))
+    
+    def embed_query(self, query: str) -> List[float]:
+        """Embed a search query; pass the result to search() to reuse it across steps."""
+        return self.get_embedding(query.strip())
+    
+    async def aembed_query(self, query: str) -> List[float]:
+        """Async variant of embed_query()."""
+        return await self.aget_embedding(query.strip())
+    
+    def search(self, query_or_vector: Union[str, List[float]], top_k: int = 5, min_score: float = config.MIN_SIMILARITY_SCORE) -> List[Dict[str, Any]]:
+        """Search for similar documents, returned in Milvus rank order (best match first).
+        
+        Accepts either the query text or its embedding from embed_query(), so callers
+        that already embedded the query (e.g. for a cache lookup) skip a second call.
+        When min_score is positive, hits scoring below it are dropped from the result,
+        so off-topic queries do not feed low-relevance chunks to the LLM; an empty
+        result then means nothing cleared the threshold. It defaults to
+        MIN_SIMILARITY_SCORE, which is 0 (no filtering) unless set: text-embedding-3
+        scores are low, and generic queries such as "summarize" can fall below any
+        fixed cut-off.
+        """
+        if isinstance(query_or_vector, str):
+            query_embedding = self.embed_query(query_or_vector)
+        else:
+            query_embedding = query_or_vector
         
         results = self.client.search(
             collection_name=self.collection_name,
@@ -111,16 +322,27 @@ class VectorStoreManager:
         formatted_results = []
         if results and len(results) > 0:
             for hit in results[0]:
+                # COSINE hits come back sorted by descending score, so stop at the first weak one
+                if min_score > 0 and hit["distance"] < min_score:
+                    break
+                entity = hit["entity"]
                 formatted_results.append({
-                    "text": hit["entity"].get("text", ""),
-                    "source": hit["entity"].get("source", "unknown"),
-                    "page": hit["entity"].get("page", 0),
-                    "chunk_index": hit["entity"].get("chunk_index", 0),
+                    "id": hit["id"],
+                    "text": entity.get("text") or "",
+                    "source": entity.get("source", "unknown"),
+                    "page": entity.get("page", 0),
+                    "chunk_index": entity.get("chunk_index", 0),
                     "score": hit["distance"]
                 })
         
         return formatted_results
     
+    async def asearch(self, query_or_vector: Union[str, List[float]], top_k: int = 5, min_score: float = config.MIN_SIMILARITY_SCORE) -> List[Dict[str, Any]]:
+        """Async variant of search(); the blocking Milvus call runs in a worker thread."""
+        if isinstance(query_or_vector, str):
+            query_or_vector = await self.aembed_query(query_or_vector)
+        return await asyncio.to_thread(self.search, query_or_vector, top_k, min_score)
+    
     def get_collection_stats(self) -> Dict[str, Any]:
         """Get statistics about the collection."""
         try:
@@ -148,15 +370,24 @@ class VectorStoreManager:
         if self.client.has_collection(self.collection_name):
             self.client.drop_collection(self.collection_name)
             self._ensure_collection()
+            self.generation += 1
+    
+    def clear_embedding_cache(self):
+        """Drop all chunk embeddings persisted on disk."""
+        _EMBEDDING_STORE.clear()
     
     def delete_by_source(self, source_name: str) -> int:
-        """Delete all documents from a specific source."""
+        """Delete all documents from a specific source and return the number of rows removed."""
         try:
             result = self.client.delete(
                 collection_name=self.collection_name,
                 filter=f'source == "{source_name}"'
             )
-            return result.get("delete_count", 0)
+            self.generation += 1
+            # Newer pymilvus returns {"delete_count": n}, older versions a list of primary keys
+            if isinstance(result, dict):
+                return result.get("delete_count", 0)
+            return len(result) if result else 0
         except Exception as e:
             print(f"Error deleting documents: {e}")
             return 0